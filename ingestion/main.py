@@ -1,3 +1,10 @@
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import itertools
+import json
+import mmap
 import logging
 import sys
 import time
@@ -5,9 +12,27 @@ import traceback
 import uuid
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import signal
 
+import numpy as np
+import torch
+import yaml
+from sentence_transformers import SentenceTransformer
+from tenacity import before_sleep_log, retry, stop_after_attempt, wait_exponential
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Distance,
+    VectorParams,
+    VectorParamsDiff,
+    OptimizersConfigDiff,
+    PointIdsList,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+)
+
 # -------------------------------
 # Logging
 # -------------------------------
@@ -31,14 +56,84 @@ else:
 
 DOCS_ROOT = Path(os.getenv("DOCS_ROOT", DEFAULT_DOCS_ROOT))
 QDRANT_URL = os.getenv("QDRANT_URL", "http://qdrant:6333")
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() in ("1", "true", "yes")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
 COLLECTION = os.getenv("QDRANT_COLLECTION", "quix_docs")
-MODEL_NAME = os.getenv("MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()  # torch | onnx | model2vec
+MODEL_NAME = os.getenv("MODEL_NAME") or (
+    "minishlab/M2V_base_output" if EMBED_BACKEND == "model2vec" else "sentence-transformers/all-MiniLM-L6-v2"
+)
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", "1024"))
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "64"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "16"))
+# >1 spawns uploader processes per buffer (opt-in)
+UPLOAD_PARALLEL = int(os.getenv("UPLOAD_PARALLEL", "1"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "64"))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", "2"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "3"))
+INDEXING_THRESHOLD = int(os.getenv("INDEXING_THRESHOLD", "20000"))
+# Quix persists /app/state across restarts when state is enabled
+DEFAULT_EMBED_CACHE_DIR = "/app/state/cache" if os.path.isdir("/app/state") else "./cache"
+EMBED_CACHE_DIR = Path(os.getenv("EMBED_CACHE_DIR", DEFAULT_EMBED_CACHE_DIR))
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "false").lower() in ("1", "true", "yes")
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))  # 0 = torch default
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "true").lower() in ("1", "true", "yes")
 
 log.info(f"Configuration:")
 log.info(f"  DOCS_ROOT: {DOCS_ROOT}")
 log.info(f"  QDRANT_URL: {QDRANT_URL}")
+log.info(f"  QDRANT_PREFER_GRPC: {QDRANT_PREFER_GRPC}")
+log.info(f"  QDRANT_GRPC_PORT: {QDRANT_GRPC_PORT}")
 log.info(f"  COLLECTION: {COLLECTION}")
 log.info(f"  MODEL_NAME: {MODEL_NAME}")
+log.info(f"  EMBED_BACKEND: {EMBED_BACKEND}")
+log.info(f"  EMBED_DEVICE: {EMBED_DEVICE}")
+log.info(f"  UPLOAD_BUFFER_SIZE: {UPLOAD_BUFFER_SIZE}")
+log.info(f"  ENCODE_BATCH_SIZE: {ENCODE_BATCH_SIZE}")
+log.info(f"  PARSE_WORKERS: {PARSE_WORKERS}")
+log.info(f"  UPLOAD_PARALLEL: {UPLOAD_PARALLEL}")
+log.info(f"  UPSERT_BATCH_SIZE: {UPSERT_BATCH_SIZE}")
+log.info(f"  UPSERT_CONCURRENCY: {UPSERT_CONCURRENCY}")
+log.info(f"  UPLOAD_RETRIES: {UPLOAD_RETRIES}")
+log.info(f"  INDEXING_THRESHOLD: {INDEXING_THRESHOLD}")
+log.info(f"  EMBED_CACHE_DIR: {EMBED_CACHE_DIR}")
+log.info(f"  TORCH_COMPILE: {TORCH_COMPILE}")
+log.info(f"  TORCH_THREADS: {TORCH_THREADS or 'default'}")
+log.info(f"  SKIP_UNCHANGED: {SKIP_UNCHANGED}")
+
+# The onnx and model2vec backends need packages that aren't in requirements.txt
+BACKEND_PACKAGES = {
+    "torch": ([], None),
+    "onnx": (["optimum", "onnxruntime"], "optimum[onnxruntime]"),
+    "model2vec": (["model2vec"], "model2vec"),
+}
+if EMBED_BACKEND not in BACKEND_PACKAGES:
+    log.error(f"❌ Unknown EMBED_BACKEND {EMBED_BACKEND!r}; use one of: {', '.join(BACKEND_PACKAGES)}")
+    sys.exit(1)
+modules, package = BACKEND_PACKAGES[EMBED_BACKEND]
+if any(importlib.util.find_spec(module) is None for module in modules):
+    log.error(f"❌ EMBED_BACKEND={EMBED_BACKEND} needs `pip install {package}` in the image")
+    sys.exit(1)
+
+# -------------------------------
+# Compiled Patterns
+# -------------------------------
+_SLUG_NON_WORD = re.compile(r'[^\w\s-]')
+_SLUG_SEP = re.compile(r'[\s_]+')
+_TAG_RE = re.compile(r"<[^>]+>")
+_IMAGE_RE = re.compile(r"!\[.*?\]\(.*?\)")
+_LINK_RE = re.compile(r"\[(.*?)\]\(.*?\)")
+# Lines that may open a code fence, heading or low-quality block
+_BLOCK_MARK_RE = re.compile(r"\n(?:#|[^\S\n]*(?:```|<div|<iframe|!!!|\?\?\?|[-*_]{3})|[^\n]*\|)")
+_BLANK_LINES_RE = re.compile(r"\n\n\n+")
+_FM_BOUNDARY_RE = re.compile(r"^-{3,}\s*$", re.MULTILINE)
+_FM_KV_RE = re.compile(r"^(\w+): +(.+?) *$", re.MULTILINE)
+# Keys/values YAML might not read back as a plain string
+_FM_NON_PLAIN_RE = re.compile(
+    r"^(?:[\W\d_]|(?:y|yes|n|no|true|false|on|off|null)$)|:\s|\s#|:$|\t",
+    re.IGNORECASE,
+)
 
 # -------------------------------
 # Helper Functions
@@ -49,17 +144,14 @@ def heading_to_slug(heading):
     if not heading:
         return None
     slug = heading.lower()
-    slug = re.sub(r'[^\w\s-]', '', slug)  # Remove special chars
-    slug = re.sub(r'[\s_]+', '-', slug)    # Replace spaces/underscores with hyphens
+    slug = _SLUG_NON_WORD.sub('', slug)  # Remove special chars
+    slug = _SLUG_SEP.sub('-', slug)       # Replace spaces/underscores with hyphens
     slug = slug.strip('-')                  # Remove leading/trailing hyphens
     return slug
 
-def build_docs_url(md_file, frontmatter_metadata, section_slug=None):
-    """Build URL using frontmatter metadata for blog posts, file path for regular docs"""
+def build_docs_url(relative_str, frontmatter_metadata, section_slug=None):
+    """Build URL using frontmatter metadata for blog posts, file path (relative to DOCS_ROOT) for regular docs"""
     try:
-        relative = md_file.relative_to(DOCS_ROOT)
-        relative_str = str(relative)
-
         # Blog posts use date-based URLs
         if 'blog/posts' in relative_str and frontmatter_metadata:
             date = frontmatter_metadata.get('date')
@@ -74,18 +166,30 @@ def build_docs_url(md_file, frontmatter_metadata, section_slug=None):
         base_url = f"https://quix.io/docs/{url_path}"
         return base_url + (f"#{section_slug}" if section_slug else "")
     except Exception as e:
-        log.warning(f"Failed to build URL for {md_file}: {e}")
+        log.warning(f"Failed to build URL for {relative_str}: {e}")
         return ""
 
-def is_low_quality_block(lines, start_idx):
+def heading_level(line):
+    """
+    Return the level of a '#' to '####' heading marker at the start of line, or 0.
+    Plain prefix checks instead of a regex: most lines don't start with '#'.
+    """
+    if line[:1] != '#':
+        return 0
+    rest = line.lstrip('#')
+    level = len(line) - len(rest)
+    return level if level <= 4 and rest[:1].isspace() else 0
+
+def is_low_quality_block(lines, stripped, start_idx):
     """
     Detect and skip low-quality content blocks.
+    stripped holds lines[i].strip() for every line, computed once by the caller.
     Returns: (is_low_quality: bool, end_index: int)
     """
     if start_idx >= len(lines):
         return (False, start_idx)
 
-    line = lines[start_idx].strip()
+    line = stripped[start_idx]
 
     # Video transcripts
     if line.startswith('??? "Transcript"') or line.startswith('!!! "Transcript"'):
@@ -93,7 +197,7 @@ def is_low_quality_block(lines, start_idx):
         # Skip until next heading or 50 lines
         end = start_idx + 1
         while end < len(lines) and end < start_idx + 50:
-            if re.match(r'^#{1,4}\s+', lines[end]):
+            if heading_level(lines[end]):
                 break
             end += 1
         return (True, end)
@@ -122,84 +226,109 @@ def is_low_quality_block(lines, start_idx):
     # Admonitions (!!!, ??? with quotes)
     if line.startswith('!!!') or (line.startswith('???') and '"' in line):
         log.debug(f"  Skipping admonition block at line {start_idx}")
-        # Skip admonition block (indented content after the marker)
+        # Skip admonition block (until a non-blank, unindented, non-marker line)
         end = start_idx + 1
-        indent_level = len(line) - len(line.lstrip())
         while end < len(lines):
-            next_line = lines[end]
-            if next_line.strip() and (len(next_line) - len(next_line.lstrip())) <= indent_level:
-                if not next_line.strip().startswith('???') and not next_line.strip().startswith('!!!'):
+            next_line = stripped[end]
+            if next_line and not lines[end][0].isspace():
+                if not next_line.startswith('???') and not next_line.startswith('!!!'):
                     break
             end += 1
         return (True, end)
 
     # Horizontal rules
-    if re.match(r'^[-*_]{3,}$', line):
+    if len(line) >= 3 and not line.strip('-*_'):
         return (True, start_idx + 1)
 
     return (False, start_idx)
 
+def section_text(lines):
+    """
+    Join a section's stripped lines the way paragraphs were accumulated:
+    runs of blank lines collapsed to one paragraph break.
+    """
+    text = '\n'.join(lines)
+    return _BLANK_LINES_RE.sub('\n\n', text).strip()
+
 def extract_sections(content, metadata):
     """
     Extract sections from markdown content with intelligent filtering.
+    Only _BLOCK_MARK_RE lines are visited; plain lines are sliced in bulk.
     Returns list of section dicts with heading, text, parent, etc.
     """
-    import frontmatter
-
     sections = []
     lines = content.split('\n')
+    stripped = [line.strip() for line in lines]
+
+    # Line numbers of candidate marker lines, found in one scan of the content
+    scan = '\n' + content
+    marks = []
+    line_no = last = 0
+    for match in _BLOCK_MARK_RE.finditer(scan):
+        line_no += scan.count('\n', last, match.start())
+        last = match.start()
+        marks.append(line_no)
 
     current_section = {
         'heading': None,
         'level': 0,
-        'paragraphs': [],
+        'lines': [],
         'parent_heading': None
     }
 
+    def save_section(section):
+        text = section_text(section['lines'])
+        if len(text) > 20:  # Minimum content length
+            sections.append({
+                'heading': section['heading'],
+                'level': section['level'],
+                'parent_heading': section['parent_heading'],
+                'text': text
+            })
+
     heading_stack = []  # Track heading hierarchy (H2 > H3 > H4)
     in_code_block = False
     filtered_count = 0
-    i = 0
+    i = 0  # First line not yet consumed
 
-    while i < len(lines):
-        line = lines[i]
-
-        # Toggle code block state
-        if line.strip().startswith('```'):
-            in_code_block = not in_code_block
-            # Skip code blocks entirely (don't index code)
-            i += 1
+    for mark in marks:
+        # Already consumed by a skipped low-quality block
+        if mark < i:
             continue
+        line = lines[mark]
 
-        # Skip lines inside code blocks
+        # Skip code blocks entirely (don't index code)
         if in_code_block:
-            i += 1
+            if stripped[mark].startswith('```'):
+                in_code_block = False
+                i = mark + 1
+            continue
+
+        # Plain lines since the last marker belong to the current section
+        current_section['lines'].extend(stripped[i:mark])
+        i = mark
+
+        # Toggle code block state
+        if stripped[mark].startswith('```'):
+            in_code_block = True
+            i = mark + 1
             continue
 
         # Check for low-quality blocks
-        is_bad, skip_to = is_low_quality_block(lines, i)
+        is_bad, skip_to = is_low_quality_block(lines, stripped, mark)
         if is_bad:
             filtered_count += 1
             i = skip_to
             continue
 
         # Check for markdown headings
-        header_match = re.match(r'^(#{1,4})\s+(.+)$', line)
-        if header_match:
+        level = heading_level(line)
+        if level and len(line) - level >= 2:
             # Save previous section if it has content
-            if current_section['paragraphs']:
-                text = '\n'.join(current_section['paragraphs']).strip()
-                if text and len(text) > 20:  # Minimum content length
-                    sections.append({
-                        'heading': current_section['heading'],
-                        'level': current_section['level'],
-                        'parent_heading': current_section['parent_heading'],
-                        'text': text
-                    })
+            save_section(current_section)
 
             # Start new section
-            level = len(header_match.group(1))
-            heading = header_match.group(2).strip()
+            heading = line[level:].strip()
 
             # Update heading stack for hierarchy tracking
             while heading_stack and heading_stack[-1]['level'] >= level:
@@ -211,175 +340,611 @@ def extract_sections(content, metadata):
             current_section = {
                 'heading': heading,
                 'level': level,
-                'paragraphs': [],
+                'lines': [],
                 'parent_heading': parent
             }
-            i += 1
-            continue
-
-        # Accumulate paragraph content
-        if line.strip():
-            current_section['paragraphs'].append(line.strip())
-        elif current_section['paragraphs'] and current_section['paragraphs'][-1] != '':
-            # Empty line = paragraph break (preserve structure)
-            current_section['paragraphs'].append('')
-
-        i += 1
+            i = mark + 1
+        # Otherwise a plain line after all: picked up with the next slice
 
     # Save final section
-    if current_section['paragraphs']:
-        text = '\n'.join(current_section['paragraphs']).strip()
-        if text and len(text) > 20:
-            sections.append({
-                'heading': current_section['heading'],
-                'level': current_section['level'],
-                'parent_heading': current_section['parent_heading'],
-                'text': text
-            })
+    if not in_code_block:
+        current_section['lines'].extend(stripped[i:])
+    save_section(current_section)
 
     log.debug(f"  Extracted {len(sections)} sections, filtered {filtered_count} low-quality blocks")
     return sections
 
 def read_markdown(md_file):
-    """Read markdown file content"""
-    with open(md_file, "r", encoding="utf-8") as f:
-        return f.read()
+    """
+    Read and hash a markdown file; files over 64 KB go through an mmap.
+    Returns: (text, content hash)
+    """
+    with open(md_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size < 64 * 1024:
+            data = f.read()
+            file_hash = hashlib.blake2b(data, digest_size=8).hexdigest()
+            text = data.decode("utf-8")
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_hash = hashlib.blake2b(mm, digest_size=8).hexdigest()
+                text = str(mm, "utf-8")
+    # Same newline handling as text mode
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text, file_hash
+
+def split_frontmatter(md_content):
+    """
+    Split YAML frontmatter from the body; plain `key: value` headers skip YAML.
+    Returns: (metadata, content)
+    """
+    text = md_content.strip()
+    if not _FM_BOUNDARY_RE.match(text):
+        return {}, text
+    try:
+        _, header, content = _FM_BOUNDARY_RE.split(text, 2)
+    except ValueError:
+        return {}, text
+
+    lines = [line for line in header.splitlines() if line.strip()]
+    pairs = _FM_KV_RE.findall(header)
+    if len(pairs) == len(lines) and not any(
+        _FM_NON_PLAIN_RE.search(key) or _FM_NON_PLAIN_RE.search(value) for key, value in pairs
+    ):
+        metadata = dict(pairs)
+    else:
+        metadata = yaml.safe_load(header)
+        if not isinstance(metadata, dict):
+            metadata = {}
+
+    return metadata, content.strip()
 
 def parse_frontmatter(md_content):
-    """Parse frontmatter and return metadata + clean content"""
-    import frontmatter
-
+    """Return frontmatter metadata + clean content from raw markdown"""
     try:
-        post = frontmatter.loads(md_content)
-        metadata = post.metadata
-        content = post.content
-
-        # Clean content: remove HTML tags, images, clean links
-        content = re.sub(r"<[^>]+>", "", content)  # Remove HTML
-        content = re.sub(r"!\[.*?\]\(.*?\)", "", content)  # Remove images
-        content = re.sub(r"\[(.*?)\]\(.*?\)", r"\1", content)  # Keep link text only
-
-        return metadata, content
+        metadata, content = split_frontmatter(md_content)
     except Exception as e:
         log.warning(f"Failed to parse frontmatter: {e}")
-        return {}, md_content
+        metadata, content = {}, md_content
+
+    # Clean content: remove HTML tags, images, clean links
+    content = _TAG_RE.sub("", content)  # Remove HTML
+    content = _IMAGE_RE.sub("", content)  # Remove images
+    content = _LINK_RE.sub(r"\1", content)  # Keep link text only
+
+    return metadata, content
+
+def iter_markdown_files(root):
+    """
+    Lazily walk the docs root for markdown files with os.scandir.
+    Yields: (path, path relative to root)
+    """
+    root = str(root)
+    root_len = len(root) + len(os.sep)
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".md"):
+                    yield Path(entry.path), entry.path[root_len:]
+
+def take_files(md_iter, n):
+    """Pull up to n more files from the walk (run in a thread: directory reads block)"""
+    return list(itertools.islice(md_iter, n))
+
+def load_document(md_file, known_hash=None):
+    """
+    Read, hash, parse and split one markdown file (runs on the parse thread pool).
+    Parsing is skipped when the content hash equals known_hash.
+    Returns: (file_hash, metadata, sections), with metadata/sections None if skipped
+    """
+    md_content, file_hash = read_markdown(md_file)
+    if file_hash == known_hash:
+        return file_hash, None, None
+    metadata, clean_content = parse_frontmatter(md_content)
+    sections = extract_sections(clean_content, metadata)
+    return file_hash, metadata, sections
+
+def section_point_id(rel_path, idx):
+    """Deterministic ID so re-runs overwrite the same point"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{rel_path}#{idx}"))
+
+def iter_sections(md_file, rel_path, metadata, sections):
+    """
+    Lazily build each section's point.
+    Yields: (point_id, text, payload)
+    """
+    doc_title = metadata.get('title', md_file.stem.replace('-', ' ').title())
+    doc_description = metadata.get('description', '')
+
+    for idx, section in enumerate(sections):
+        section_heading = section.get('heading')
+        section_text = section.get('text', '')
+        section_slug = heading_to_slug(section_heading) if section_heading else None
+
+        # Build URL with optional section anchor
+        url = build_docs_url(rel_path, metadata, section_slug)
+
+        point_id = section_point_id(rel_path, idx)
+
+        # Create payload (Supabase-compatible format)
+        yield point_id, section_text, {
+            "title": doc_title,
+            "subtitle": section_heading,
+            "description": doc_description if doc_description else None,
+            "text": section_text,
+            "url": url,
+            "heading": section_heading,
+            "slug": section_slug,
+            "path": rel_path,
+        }
 
 # -------------------------------
-# Main Ingestion Logic
+# Embedding Backends
 # -------------------------------
 
-def ingest_docs():
-    """Main ingestion function - crawl docs and index in Qdrant"""
-    import frontmatter
-    from sentence_transformers import SentenceTransformer
-    from qdrant_client import QdrantClient
-    from qdrant_client.models import Distance, VectorParams, PointStruct
+class OnnxEncoder:
+    """Sentence-transformers model on ONNX Runtime (CPU). Requires optimum[onnxruntime]"""
+
+    def __init__(self, model_name):
+        from huggingface_hub import hf_hub_download
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        # Export to ONNX once; later starts load the export saved in the cache dir
+        export_dir = EMBED_CACHE_DIR / "onnx" / model_name.replace("/", "--")
+        if export_dir.exists():
+            self.model = ORTModelForFeatureExtraction.from_pretrained(export_dir, provider="CPUExecutionProvider")
+        else:
+            log.info(f"📦 Exporting {model_name} to ONNX in {export_dir}")
+            self.model = ORTModelForFeatureExtraction.from_pretrained(
+                model_name, export=True, provider="CPUExecutionProvider"
+            )
+            tmp = export_dir.with_suffix(".tmp")
+            self.model.save_pretrained(tmp)
+            os.replace(tmp, export_dir)
+
+        # Match the sentence-transformers pipeline: truncation length and pooling mode
+        with open(hf_hub_download(model_name, "sentence_bert_config.json")) as f:
+            self.max_seq_length = json.load(f).get("max_seq_length", self.tokenizer.model_max_length)
+        with open(hf_hub_download(model_name, "1_Pooling/config.json")) as f:
+            self.cls_pooling = json.load(f).get("pooling_mode_cls_token", False)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.config.hidden_size
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        # Longest-first order so each batch pads only to its own longest text
+        order = np.argsort([-len(s) for s in sentences])
+        vectors = np.empty((len(sentences), self.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        for start in range(0, len(sentences), batch_size):
+            idx = order[start:start + batch_size]
+            encoded = self.tokenizer(
+                [sentences[i] for i in idx],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            hidden = self.model(**encoded).last_hidden_state
+            if self.cls_pooling:
+                pooled = hidden[:, 0]
+            else:
+                # Masked mean pooling as one batched matmul
+                mask = encoded["attention_mask"].astype(np.float32)
+                pooled = np.matmul(mask[:, None, :], hidden)[:, 0]
+                pooled /= np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None)
+            vectors[idx] = pooled
+
+        if normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
+
+class StaticEncoder:
+    """model2vec static embeddings: fast on CPU, lower quality. Requires model2vec"""
+
+    def __init__(self, model_name):
+        from model2vec import StaticModel
+
+        self.model = StaticModel.from_pretrained(model_name)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.dim
+
+    def encode(self, sentences, normalize_embeddings=False, **kwargs):
+        vectors = np.asarray(self.model.encode(list(sentences)), dtype=np.float32)
+        if normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors
+
+def load_model():
+    """Load the embedding model for the configured EMBED_BACKEND"""
+    if EMBED_BACKEND == "onnx":
+        return OnnxEncoder(MODEL_NAME)
+    if EMBED_BACKEND == "model2vec":
+        return StaticEncoder(MODEL_NAME)
+
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    model = SentenceTransformer(MODEL_NAME, device=EMBED_DEVICE)
+    model.eval()
+    if EMBED_DEVICE.startswith("cuda"):
+        # fp16 halves weight/activation bandwidth; embed_texts casts back to float32
+        model.half()
+        log.info(f"⚡ Using fp16 inference on {EMBED_DEVICE}")
+    if TORCH_COMPILE:
+        # dynamic=True avoids a recompile per padded sequence length
+        try:
+            model[0].auto_model = torch.compile(model[0].auto_model, mode="reduce-overhead", dynamic=True)
+            log.info("⚡ Compiled encoder with torch.compile")
+        except Exception as e:
+            log.warning(f"torch.compile unavailable, running eager: {e}")
+    return model
 
-    log.info("🚀 Ingestion service starting")
+# -------------------------------
+# Main Ingestion Logic
+# -------------------------------
 
-    # Connect to Qdrant
-    log.info(f"🔌 Connecting to Qdrant at {QDRANT_URL}")
-    client = QdrantClient(url=QDRANT_URL)
+def text_key(text):
+    """Content hash used to key cached embeddings"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
 
-    # Delete existing collection (fresh start)
+def embedding_cache_path():
+    """Embedding cache file for the configured model"""
+    return EMBED_CACHE_DIR / f"{MODEL_NAME.replace('/', '--')}.npz"
+
+def load_embedding_cache(path):
+    """Load {text_key: vector} saved by a previous run, or {} if there is none"""
+    if not path.exists():
+        return {}
     try:
-        client.delete_collection(collection_name=COLLECTION)
-        log.info(f"🗑️  Deleted existing collection: {COLLECTION}")
+        with np.load(path) as data:
+            return dict(zip((k.tobytes() for k in data['keys']), data['vecs']))
     except Exception as e:
-        log.info(f"✅ Collection {COLLECTION} doesn't exist yet (this is fine)")
+        log.warning(f"Failed to load embedding cache {path}: {e}")
+        return {}
+
+def save_embedding_cache(path, cache):
+    """Persist {text_key: vector}, replacing the previous file atomically"""
+    if not cache:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    keys = np.frombuffer(b"".join(cache.keys()), dtype=np.uint8).reshape(len(cache), -1)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, keys=keys, vecs=np.stack(list(cache.values())))
+    os.replace(tmp, path)
+
+# Bump whenever section or payload output changes
+MANIFEST_VERSION = 1
+
+def manifest_path():
+    """Per-file hashes from the last successful run into this collection with this model"""
+    return EMBED_CACHE_DIR / f"{COLLECTION}--{MODEL_NAME.replace('/', '--')}.json"
+
+def load_manifest(path):
+    """
+    Load {rel_path: {"hash", "keys"}} saved by a previous run, or {} if there
+    is none or it was written for a different MANIFEST_VERSION
+    """
+    if not path.exists():
+        return {}
+    try:
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+    except Exception as e:
+        log.warning(f"Failed to load file manifest {path}: {e}")
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        log.info(f"🗄️ Ignoring file manifest {path} from another manifest version")
+        return {}
+    return manifest["files"]
+
+def save_manifest(path, manifest):
+    """Persist {rel_path: {"hash", "keys"}}, replacing the previous file atomically"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"version": MANIFEST_VERSION, "files": manifest}), encoding="utf-8")
+    os.replace(tmp, path)
+
+def embed_texts(model, keys, texts, cache, previous):
+    """
+    Encode a buffer of section texts (keyed by text_key) in one call,
+    reusing vectors from this run (cache) or the previous one (previous).
+    """
+    missing = {}
+    for k, text in zip(keys, texts):
+        if k in cache:
+            continue
+        if k in previous:
+            cache[k] = previous[k]
+        else:
+            missing.setdefault(k, text)
+
+    if missing:
+        # encode() length-sorts the whole buffer, so batches pad less
+        with torch.inference_mode():
+            vectors = model.encode(
+                list(missing.values()),
+                batch_size=ENCODE_BATCH_SIZE,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                device=EMBED_DEVICE,
+            )
+        cache.update(zip(missing, vectors))
+
+    # One float32 matrix; the uploader converts it with one tolist() per batch
+    return np.stack([cache[k] for k in keys]).astype(np.float32, copy=False)
+
+# Retry a failed buffer with backoff (safe: point IDs are deterministic)
+@retry(
+    stop=stop_after_attempt(UPLOAD_RETRIES),
+    wait=wait_exponential(multiplier=1, max=4),
+    before_sleep=before_sleep_log(log, logging.WARNING),
+    reraise=True,
+)
+async def upload_batch(client, uploader, ids, vectors, payloads, label="batch"):
+    """Upload one buffer of sections with the client's uploader, on the uploader thread pool"""
+    # upload_collection blocks, so it runs off the event loop
+    await asyncio.get_running_loop().run_in_executor(uploader, functools.partial(
+        client.upload_collection,
+        collection_name=COLLECTION,
+        vectors=vectors,
+        payload=payloads,
+        ids=ids,
+        batch_size=UPSERT_BATCH_SIZE,
+        parallel=UPLOAD_PARALLEL,
+        # Acknowledged once queued; index_docs awaits every upload
+        wait=False,
+    ))
+    log.info(f"✅ Indexed {label} of {len(ids)} sections")
+
+async def delete_stale_points(client, live_ids):
+    """Delete points left over from sections that no longer exist in the docs"""
+    stale = []
+    offset = None
+    while True:
+        records, offset = await client.scroll(
+            collection_name=COLLECTION,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        stale.extend(r.id for r in records if str(r.id) not in live_ids)
+        if offset is None:
+            break
+
+    if stale:
+        await client.delete(collection_name=COLLECTION, points_selector=PointIdsList(points=stale))
+        log.info(f"🗑️  Deleted {len(stale)} stale sections")
+
+async def enable_indexing(client):
+    """Restore the indexing threshold that was disabled for the bulk upload"""
+    log.info(f"🏗️ Enabling indexing (threshold {INDEXING_THRESHOLD})")
+    await client.update_collection(
+        collection_name=COLLECTION,
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD),
+    )
 
-    # Load embedding model
-    log.info(f"🧠 Loading embedding model: {MODEL_NAME}")
-    model = SentenceTransformer(MODEL_NAME)
-    vector_size = model.get_sentence_embedding_dimension()
-    log.info(f"✅ Model loaded. Vector size: {vector_size}")
+async def ingest_docs():
+    """Main ingestion function - crawl docs and index in Qdrant"""
+    log.info("🚀 Ingestion service starting")
 
-    # Create collection
-    log.info(f"📦 Creating collection: {COLLECTION}")
-    client.create_collection(
-        collection_name=COLLECTION,
-        vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE),
+    # Connect to Qdrant; gRPC sends vectors as packed floats, not JSON arrays
+    transport = f"gRPC port {QDRANT_GRPC_PORT}" if QDRANT_PREFER_GRPC else "REST"
+    log.info(f"🔌 Connecting to Qdrant at {QDRANT_URL} ({transport})")
+    client = AsyncQdrantClient(
+        url=QDRANT_URL,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        grpc_port=QDRANT_GRPC_PORT,
+        timeout=180,
     )
+    try:
+        await index_docs(client)
+    finally:
+        await client.close()
 
-    # Walk through all markdown files
-    md_files = list(DOCS_ROOT.rglob("*.md"))
-    log.info(f"📄 Found {len(md_files)} markdown files to process")
+async def index_docs(client):
+    """Walk, parse, embed and upload the docs into the collection"""
+    loop = asyncio.get_running_loop()
 
-    points = []
-    total_sections = 0
-    files_processed = 0
+    # Walk the docs in a thread, overlapping the model load
+    md_iter = iter_markdown_files(DOCS_ROOT)
+    log.info(f"📄 Scanning {DOCS_ROOT} for markdown files")
+    first_files = loop.run_in_executor(None, take_files, md_iter, 2 * PARSE_WORKERS)
 
-    for md_file in md_files:
-        try:
-            log.info(f"➡️ Processing {files_processed+1}/{len(md_files)}: {md_file.relative_to(DOCS_ROOT)}")
-
-            # Read and parse file
-            md_content = read_markdown(md_file)
-            metadata, clean_content = parse_frontmatter(md_content)
-
-            # Extract metadata
-            doc_title = metadata.get('title', md_file.stem.replace('-', ' ').title())
-            doc_description = metadata.get('description', '')
-
-            # Extract sections
-            sections = extract_sections(clean_content, metadata)
-            log.info(f"✂️ {len(sections)} sections created")
-
-            # Create search payloads for each section
-            for section in sections:
-                section_heading = section.get('heading')
-                section_text = section.get('text', '')
-                section_slug = heading_to_slug(section_heading) if section_heading else None
-
-                # Build URL with optional section anchor
-                url = build_docs_url(md_file, metadata, section_slug)
-
-                # Create payload (Supabase-compatible format)
-                payload = {
-                    "title": doc_title,
-                    "subtitle": section_heading,
-                    "description": doc_description if doc_description else None,
-                    "text": section_text,
-                    "url": url,
-                    "heading": section_heading,
-                    "slug": section_slug,
-                    "path": str(md_file.relative_to(DOCS_ROOT)),
-                }
-
-                # Generate embedding
-                embedding = model.encode(section_text).tolist()
-
-                # Create point
-                point_id = str(uuid.uuid4())
-                point = PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload=payload
-                )
-                points.append(point)
-                total_sections += 1
-
-            files_processed += 1
-
-            # Batch upsert every 100 points
-            if len(points) >= 100:
-                client.upsert(collection_name=COLLECTION, points=points)
-                log.info(f"✅ Indexed batch of {len(points)} sections")
-                points = []
+    # Load embedding model
+    log.info(f"🧠 Loading embedding model: {MODEL_NAME} ({EMBED_BACKEND})")
+    model = load_model()
+    vector_size = model.get_sentence_embedding_dimension()
+    log.info(f"✅ Model loaded. Vector size: {vector_size}")
+
+    # Recreate the collection only if the vector size changed
+    if await client.collection_exists(collection_name=COLLECTION):
+        info = await client.get_collection(collection_name=COLLECTION)
+        if info.config.params.vectors.size != vector_size:
+            await client.delete_collection(collection_name=COLLECTION)
+            log.info(f"🗑️  Deleted collection with stale vector size: {COLLECTION}")
 
+    # No indexing during the upload; int8 copy in RAM, float32 originals on disk
+    quantization = ScalarQuantization(
+        scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True),
+    )
+    collection_reused = await client.collection_exists(collection_name=COLLECTION)
+    if collection_reused:
+        log.info(f"♻️ Reusing existing collection: {COLLECTION}")
+        await client.update_collection(
+            collection_name=COLLECTION,
+            vectors_config={"": VectorParamsDiff(on_disk=True)},
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+            quantization_config=quantization,
+        )
+    else:
+        log.info(f"📦 Creating collection: {COLLECTION}")
+        await client.create_collection(
+            collection_name=COLLECTION,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=True),
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+            quantization_config=quantization,
+        )
+
+    # Indexing is restored even if the run fails
+    try:
+        # Embeddings from the previous run are reused for unchanged section text
+        cache_path = embedding_cache_path()
+        previous = load_embedding_cache(cache_path)
+        cache = {}
+        log.info(f"🗄️ Loaded {len(previous)} cached embeddings from {cache_path}")
+
+        # Files unchanged since the last successful run are already indexed
+        files_path = manifest_path()
+        previous_files = load_manifest(files_path) if SKIP_UNCHANGED and collection_reused else {}
+        files = {}
+        log.info(f"🗄️ Loaded {len(previous_files)} file hashes from {files_path}")
+
+        # Only trust the manifest if the collection holds exactly its points
+        if previous_files:
+            expected = sum(len(entry["keys"]) for entry in previous_files.values())
+            stored = (await client.count(collection_name=COLLECTION, exact=True)).count
+            if stored != expected:
+                log.warning(f"⚠️ Collection has {stored} points, manifest lists {expected}; re-indexing all files")
+                previous_files = {}
+
+        # Each full buffer becomes a task: encode (one thread), then upload
+        encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoder")
+        uploader = ThreadPoolExecutor(max_workers=UPSERT_CONCURRENCY, thread_name_prefix="uploader")
+        uploads = []
+
+        async def index_buffer(ids, keys, texts, payloads, label="batch"):
+            """Encode one buffer off the event loop, then upload it"""
+            vectors = await loop.run_in_executor(encoder, embed_texts, model, keys, texts, cache, previous)
+            await upload_batch(client, uploader, ids, vectors, payloads, label)
+
+        ids, text_keys, texts, payloads = [], [], [], []
+        live_ids = set()
+        total_sections = 0
+        files_found = 0
+        files_processed = 0
+        files_unchanged = 0
+
+        # Parse up to 2 * PARSE_WORKERS files ahead, consumed in completion order
+        try:
+            with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+                pending = {}
+                room = 2 * PARSE_WORKERS
+                batch = await first_files
+                walk_done = False
+
+                while True:
+                    for md_file, rel_path in batch:
+                        known_hash = previous_files.get(rel_path, {}).get("hash")
+                        pending[loop.run_in_executor(pool, load_document, md_file, known_hash)] = (md_file, rel_path)
+                        files_found += 1
+                    walk_done = walk_done or len(batch) < room
+                    if not pending:
+                        break
+
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                    for doc in done:
+                        md_file, rel_path = pending.pop(doc)
+                        log.info(f"➡️ Processing {files_processed+1}: {rel_path}")
+                        try:
+                            file_hash, metadata, sections = doc.result()
+                        except Exception as e:
+                            log.error(f"❌ Failed to process {md_file}: {e}")
+                            log.error(traceback.format_exc())
+                            continue
+
+                        # Unchanged file: keep its points and carry over its embeddings
+                        if sections is None:
+                            entry = files[rel_path] = previous_files[rel_path]
+                            for idx, key in enumerate(entry["keys"]):
+                                live_ids.add(section_point_id(rel_path, idx))
+                                key = bytes.fromhex(key)
+                                if key in previous:
+                                    cache[key] = previous[key]
+                            log.info(f"⏭️ Unchanged, {len(entry['keys'])} sections kept")
+                            files_unchanged += 1
+                            files_processed += 1
+                            continue
+
+                        log.info(f"✂️ {len(sections)} sections created")
+                        keys = []
+
+                        # Stream sections into the buffer, across files
+                        for point_id, text, payload in iter_sections(md_file, rel_path, metadata, sections):
+                            live_ids.add(point_id)
+                            key = text_key(text)
+                            ids.append(point_id)
+                            text_keys.append(key)
+                            texts.append(text)
+                            payloads.append(payload)
+                            keys.append(key.hex())
+                            total_sections += 1
+
+                            # Encode and schedule an upload every UPLOAD_BUFFER_SIZE sections
+                            if len(ids) >= UPLOAD_BUFFER_SIZE:
+                                uploads.append(asyncio.create_task(index_buffer(ids, text_keys, texts, payloads)))
+                                ids, text_keys, texts, payloads = [], [], [], []
+
+                            if len(uploads) >= UPSERT_CONCURRENCY:
+                                finished, in_flight = await asyncio.wait(uploads, return_when=asyncio.FIRST_COMPLETED)
+                                for task in finished:
+                                    task.result()  # Re-raise a failed upload
+                                uploads = list(in_flight)
+
+                        files[rel_path] = {"hash": file_hash, "keys": keys}
+                        files_processed += 1
+
+                    # Top the parser back up to 2 * PARSE_WORKERS files
+                    room = 2 * PARSE_WORKERS - len(pending)
+                    batch = [] if walk_done else await loop.run_in_executor(None, take_files, md_iter, room)
+
+            # Upload remaining sections and wait for everything still in flight
+            if ids:
+                uploads.append(asyncio.create_task(index_buffer(ids, text_keys, texts, payloads, label="final batch")))
+            await asyncio.gather(*uploads)
+        except BaseException:
+            # Stop uploads and wait for running work before saving the cache
+            for task in uploads:
+                task.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+            encoder.shutdown(wait=True, cancel_futures=True)
+            uploader.shutdown(wait=True, cancel_futures=True)
+            # Keep the previous run's entries too: this run didn't reach every file
+            save_embedding_cache(cache_path, {**previous, **cache})
+            log.info(f"🗄️ Saved embeddings to {cache_path} before aborting")
+            raise
+        encoder.shutdown()
+        uploader.shutdown()
+
+        await delete_stale_points(client, live_ids)
+
+        # Only this run's embeddings are kept, so the cache tracks the docs
+        save_embedding_cache(cache_path, cache)
+        log.info(f"🗄️ Saved {len(cache)} embeddings to {cache_path}")
+        save_manifest(files_path, files)
+        log.info(f"🗄️ Saved {len(files)} file hashes to {files_path}")
+    except BaseException:
+        try:
+            await enable_indexing(client)
         except Exception as e:
-            log.error(f"❌ Failed to process {md_file}: {e}")
-            log.error(traceback.format_exc())
-            continue
+            log.error(f"❌ Failed to re-enable indexing: {e}")
+        raise
 
-    # Upsert remaining points
-    if points:
-        client.upsert(collection_name=COLLECTION, points=points)
-        log.info(f"✅ Indexed final batch of {len(points)} sections")
+    # Re-enable indexing now that the bulk upload is done
+    await enable_indexing(client)
 
     log.info("="*70)
     log.info("🎉 Ingestion complete!")
-    log.info(f"📊 Files processed: {files_processed}/{len(md_files)}")
+    log.info(f"📊 Files processed: {files_processed}/{files_found} ({files_unchanged} unchanged)")
     log.info(f"📊 Total sections indexed: {total_sections}")
     log.info("="*70)
 
@@ -389,7 +954,7 @@ def ingest_docs():
 
 if __name__ == "__main__":
     try:
-        ingest_docs()
+        asyncio.run(ingest_docs())
     except KeyboardInterrupt:
         log.info("🛑 Ingestion interrupted by user")
         sys.exit(0)
@@ -0,0 +1,81 @@
+"""Regression tests: the optimized parsing helpers must match the original code"""
+import random
+import re
+import unittest
+
+import yaml
+
+import main
+
+
+def strip_markup_reference(content):
+    """The original parse_frontmatter content cleanup"""
+    content = re.sub(r"<[^>]+>", "", content)
+    content = re.sub(r"!\[.*?\]\(.*?\)", "", content)
+    return re.sub(r"\[(.*?)\]\(.*?\)", r"\1", content)
+
+
+class StripMarkupTest(unittest.TestCase):
+    def assert_matches_reference(self, text):
+        self.assertEqual(main.parse_frontmatter(text)[1], strip_markup_reference(text.strip()), repr(text))
+
+    def test_examples(self):
+        for text in [
+            "See [the docs](https://quix.io/docs) for <b>more</b>.",
+            "[![badge](https://img.shields.io/x.svg)](https://github.com/quixio)",
+            "[text ![img](i.png)](http://x)",
+            "[![a](b) caption](c)",
+            "[a](x ![b](c) y)",
+            "[<b>bold</b> link](y)",
+            "[x](y <z) w>",
+            "![a<b](c)>",
+        ]:
+            self.assert_matches_reference(text)
+
+    def test_random_markup(self):
+        rng = random.Random(0)
+        for _ in range(20000):
+            self.assert_matches_reference("".join(rng.choice("[]()!<> ab\n") for _ in range(rng.randint(0, 16))))
+
+
+class SplitFrontmatterTest(unittest.TestCase):
+    def assert_matches_yaml(self, header):
+        metadata, _ = main.split_frontmatter(f"---\n{header}\n---\nBody")
+        # repr compares types too (and treats nan as equal to itself)
+        self.assertEqual(repr(metadata), repr(yaml.safe_load(header)), repr(header))
+
+    def test_examples(self):
+        for header in [
+            "title: Stream processing glossary\ndate: 2023-07-12\nslug: glossary",
+            "title: .inf",
+            "title: -.inf",
+            "title: .nan",
+            "title: +.5",
+            "title: 42",
+            "title: yes",
+            "title: ~",
+            "title: 'Quoted'",
+            "title: Why? Because # not a comment",
+            "title: Comment # here",
+            "123: numeric key",
+            "yes: bool key",
+            "on: bool key",
+            "null: null key",
+        ]:
+            self.assert_matches_yaml(header)
+
+    def test_random_values(self):
+        rng = random.Random(0)
+        tokens = list("abcXYZ ,.-'()?!&/:;#\"%0123456789") + ["yes", "on", "null", "inf", "nan", " #", ": ", "e5"]
+        for _ in range(5000):
+            key = rng.choice(["title", "description", "date", "slug", "on", "Yes", "k2", "_x"])
+            value = "".join(rng.choice(tokens) for _ in range(rng.randint(1, 12)))
+            try:
+                yaml.safe_load(f"{key}: {value}")
+            except yaml.YAMLError:
+                continue  # Invalid headers fail the same way in both
+            self.assert_matches_yaml(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    unittest.main()